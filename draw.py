@@ -10,9 +10,11 @@ other multiple, it is trimmed before processing further.
 import re
 
 from argparse import ArgumentParser
+from collections import defaultdict
 from ete3 import Tree, TreeStyle, NodeStyle
-from processing import change_support_format, trim_name, add_multi_annotation, \
-    match_score, hmmer_name_mapping, are_ancestors
+from processing import change_support_format, trim_name, annotate_tree, \
+    score_matrix, hmmer_name_mapping, DisjointSet, dfs_intervals, \
+    reciprocal_matches, remove_nested_matches
 
 parser = ArgumentParser('Draw a tree and color multiples')
 parser.add_argument('-t', type=str, help='Tree file (Newick)')
@@ -50,18 +52,24 @@ if args.bracketed_support:
 # Preparing the tree for further analysis
 tree = Tree(tree_line, quoted_node_names=args.quoted_names)
 tree.set_outgroup(tree.get_midpoint_outgroup())
+# Only internal nodes are ever deleted below, so this list stays valid
+leaves = tree.get_leaves()
 
 # Process raw names if necessary
 if args.hmmer_ids:
     print('Processing HMMER IDs...')
-    old_names = [x.name for x in tree.get_leaves()]
+    old_names = [x.name for x in leaves]
     name_map = hmmer_name_mapping(old_names, args.rsga_ids)
-    for leaf in tree.get_leaves():
+    for leaf in leaves:
         leaf.name = name_map[leaf.name]
 
-for node in tree.traverse():
-    if not node.is_leaf() and node.support < args.support_threshold:
-        node.delete(prevent_nondicotomic=False, preserve_branch_length=True)
+# Collect the nodes first: deleting relinks children, which shouldn't happen
+# while the tree is being traversed. Level order keeps children order (and so
+# the drawing) the same as when deleting on the fly.
+to_collapse = [x for x in tree.traverse()
+               if not x.is_leaf() and x.support < args.support_threshold]
+for node in to_collapse:
+    node.delete(prevent_nondicotomic=False, preserve_branch_length=True)
 
 ################################################################################
 # Defining the multiple set
@@ -69,21 +77,20 @@ for node in tree.traverse():
 
 print('Selecting multiples...', end='')
 multies = {} #Name-to-node mapping
-multi_re = re.compile('(.+)_\d+$')
+multi_re = re.compile(r'(.+)_\d+$')
 
-for leaf in tree.get_leaves():
+for leaf in leaves:
     leaf.name = trim_name(leaf.name)
     if multi_re.match(leaf.name):
         multies[leaf.name] = leaf
 print(f'{len(multies)} found')
 # Trim subdomain numbers from non-multiple sequences
 print('Trimming postfixes from non-multiples...')
-to_trim = {} #Name:prefix
+by_prefix = defaultdict(list) #Prefix:names
 for name in multies:
-    prefix = '_'.join(name.split('_')[:-1])
-    matches = [x for x in multies if prefix in x]
-    if len(matches) < 2:
-        to_trim[name] = prefix
+    by_prefix[name.rsplit('_', 1)[0]].append(name)
+to_trim = {names[0]: prefix for prefix, names in by_prefix.items()
+           if len(names) < 2} #Name:prefix
 for name in to_trim:
     #multies[to_trim[name]] = multies[name]
     multies[name].name = to_trim[name]
@@ -92,9 +99,8 @@ for name in to_trim:
 # the group, its style will be overridden. If not, this is left as the default.
 multinode_style = NodeStyle()
 multinode_style['bgcolor'] = 'gray'
-for leaf in tree.get_leaves():
-    if leaf in multies.values():
-        leaf.set_style(multinode_style)
+for leaf in multies.values():
+    leaf.set_style(multinode_style)
 
 ################################################################################
 # Matching parts of a multidomain gene to each other and merging matches into
@@ -106,60 +112,25 @@ if args.skip_pairing:
 else:
     print('Propagating multiples annotation...')
     # Mapping out descendants
-    for node in tree.traverse(strategy='postorder'):
-        add_multi_annotation(node, multies)
+    tin, tout, all_nodes = dfs_intervals(tree)
+    annotate_tree(tree, multies, all_nodes)
     # Selecting reciprocal best hit for each node with multidomain descendants
 
     # Do not process leaves to avoid bloating match set and performing costly
     # operations on them
     print('Generating match matrix...')
-    node_refs = [x for x in tree.traverse('postorder') if x.multi_descendants and not x.is_leaf()]
-    match_matrix = [[match_score(x.multi_descendants, y.multi_descendants) for x in node_refs]
-                    for y in node_refs]
-    matches = []
+    node_refs = [x for x in all_nodes if x.multi_descendants and not x.is_leaf()]
+    match_matrix = score_matrix([x.multi_descendants for x in node_refs], args.s)
     print('Searching through the match matrix...', end='')
-    for index, line in enumerate(match_matrix):
-        for element in range(index+1, len(line)):
-            if line[element] < args.s or match_matrix[element][index] < args.s:
-                # Match quality cutoff. Can be tweaked to choose between larger
-                # looser groups (at lower values) and exact matches (at 1.0)
-                continue
-            if (element, index) in matches:
-                continue
-            if are_ancestors(node_refs[index], node_refs[element]):
-                continue
-            matches.append((index, element))
-    node_matches = [(node_refs[x[0]], node_refs[x[1]]) for x in matches]
-    print(f'{len(node_matches)} raw matches found')
+    ref_tin = [tin[x] for x in node_refs]
+    ref_tout = [tout[x] for x in node_refs]
+    matches = reciprocal_matches(match_matrix, ref_tin, ref_tout, args.s)
+    print(f'{len(matches)} raw matches found')
     print('Cleaning match set...', end='')
     # Preserve only the most ancient possible matches, discarding newer ones
     # In other words, if two clades match, remove all matches for their subclades
-    clean_matches = []
-    for match in node_matches:
-        anc0 = match[0].get_ancestors()
-        anc1 = match[1].get_ancestors()
-        found = False
-        for other_match in node_matches:
-            if match == other_match:
-                continue
-            # Remove match (A,B) if there is match (C, D) such that C is the
-            # ancestor of A and D is the ancestor of B
-            if other_match[0] in anc0 and other_match[1] in anc1:
-                found = True
-                break
-            elif other_match[1] in anc0 and other_match[0] in anc1:
-                found = True
-                break
-            # Remove match (A, B) if there is match (A, C) such that C is the
-            # ancestor of B
-            if match[0] in other_match and (other_match[0] in anc1 or other_match[1] in anc1):
-                found = True
-                break
-            if match[1] in other_match and (other_match[0] in anc0 or other_match[1] in anc0):
-                found = True
-                break
-        if not found:
-            clean_matches.append(match)
+    clean_matches = [(node_refs[x[0]], node_refs[x[1]])
+                     for x in remove_nested_matches(matches, ref_tin, ref_tout)]
 
     tmp = set()
     for match in clean_matches:
@@ -173,17 +144,12 @@ else:
     # For example, if three nodes have mutually overlapping sets of descendants,
     # they should become a single group of three, not three pairwise matches
     print('Merging matches into groups...', end='')
-    groups = []
+    disjoint_set = DisjointSet()
     for match in clean_matches:
-        added = False
-        for group in groups:
-            if match[0] in group or match[1] in group:
-                group.add(match[0])
-                group.add(match[1])
-                added = True
-                break
-        if not added:
-            groups.append(set(match))
+        disjoint_set.add(match[0])
+        disjoint_set.add(match[1])
+        disjoint_set.union(match[0], match[1])
+    groups = disjoint_set.groups()
 
     print(f'produced {len(groups)} groups')
     # Perceptually distinct palette for groups. Copied from matplolib.cm.tab20
@@ -2,11 +2,31 @@
 Various functions for tree and name preprocessing
 """
 
+import mmap
+import os
 import re
+import tempfile
+
+from collections import defaultdict
+
+# Bracketed branch support, eg ':0.8[65]'
+_NODE_RE = re.compile(r':([0-9.Ee+-]+)\[([0-9.Ee+-]+)\]', re.ASCII)
+_NODE_BYTES_RE = re.compile(_NODE_RE.pattern.encode('ascii'))
+# Domain position in a leaf name, eg '_(5-177)'
+_DOMAIN_RE = re.compile(r'_\(\d+-\d+\)')
+# Domain coordinates in HMMER IDs; the first group is the domain start
+_HMMER_POS_RE = re.compile(r'/(\d+)-\d+ ')
+_RSGA_POS_RE = re.compile(r'(\d+)-\d+')
 
 
 def sub_replacement(match):
-    return match.group(2)+':'+match.group(1)
+    """
+    Swap branch length and support in a single support regex match.
+
+    change_support_format uses an equivalent backreference template instead,
+    which is expanded by the regex engine without calling back into Python
+    """
+    return f'{match[2]}:{match[1]}'
 
 
 def change_support_format(tree_line):
@@ -19,9 +39,60 @@ def change_support_format(tree_line):
     :param str tree_line: Parseable Newick
     :return:
     """
-    node_re = re.compile(':([\d.E-]+)\[([\d.E-]+)\]')
-    return re.sub(node_re, sub_replacement, tree_line, count=0)
+    if '[' not in tree_line:
+        # Nothing to convert, don't bother running the regex
+        return tree_line
+    return _NODE_RE.sub(r'\2:\1', tree_line)
+
+
+def change_support_format_many(tree_lines):
+    """
+    Same as change_support_format, but for a list of Newick lines (eg a file of
+    bootstrap trees). Returns a list.
+    :param tree_lines:
+    :return:
+    """
+    sub = _NODE_RE.sub
+    return [sub(r'\2:\1', x) if '[' in x else x for x in tree_lines]
+
+
+def change_support_format_stream(in_path, out_path):
+    """
+    Same as change_support_format, but for files.
 
+    Input file is memory-mapped and the result is written out match by match,
+    so neither the input nor the output tree is held in memory as a whole.
+    Output goes to a new temporary file next to out_path, which then replaces
+    out_path, so converting a file in place (in_path == out_path) is safe and
+    no existing file other than out_path is touched.
+    :param str in_path: Newick file with bracketed support values
+    :param str out_path: File to write the converted Newick to
+    :return:
+    """
+    in_path = os.fspath(in_path)
+    out_path = os.fspath(out_path)
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(out_path)) or '.', suffix='.tmp')
+    try:
+        # mkstemp makes the file private; give it the same mode open() would
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_path, 0o666 & ~umask)
+        with open(in_path, 'rb') as in_file, os.fdopen(fd, 'wb') as out_file:
+            # Empty files cannot be mapped, and have nothing to convert anyway
+            if os.fstat(in_file.fileno()).st_size:
+                with mmap.mmap(in_file.fileno(), 0,
+                               access=mmap.ACCESS_READ) as mapped:
+                    last_end = 0
+                    for match in _NODE_BYTES_RE.finditer(mapped):
+                        out_file.write(mapped[last_end:match.start()])
+                        out_file.write(match.group(2) + b':' + match.group(1))
+                        last_end = match.end()
+                    out_file.write(mapped[last_end:])
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
 
 def trim_name(name):
     """
@@ -29,37 +100,175 @@ def trim_name(name):
 
     Remove domain position (if any)
     """
-    return re.sub('_\(\d+-\d+\)', lambda x: '', name)
+    if '_(' not in name:
+        return name
+    return _DOMAIN_RE.sub('', name)
+
+
+def annotate_tree(tree, multies, postorder=None):
+    """
+    Add multiples descending from each node to node annotation
+
+    Nodes are annotated in postorder, so that the children are always
+    annotated before their parent. postorder is the list of all nodes of the
+    tree in that order, as returned by dfs_intervals; if it is not given, it
+    is computed here.
+
+    Multiples are stored in `multi_descendants` as an int bitmask of their
+    prefixes, so that a parent just ORs the masks of its children. Returns the
+    dict {prefix: bit number}.
+    multies is a collection of multiple leaf names (or a dict keyed by them).
+    """
+    if postorder is None:
+        postorder = dfs_intervals(tree)[2]
+    if isinstance(multies, (list, tuple)):
+        # Checked for every leaf, so make sure lookups don't scan a sequence
+        multies = frozenset(multies)
+    prefix_ids = {}
+    for node in postorder:
+        children = node.children
+        bits = 0
+        if children:
+            for child in children:
+                bits |= child.multi_descendants
+        else:
+            # For a leaf, add either name or nothing
+            name = node.name
+            if name in multies:
+                prefix = name.rsplit('_', 1)[0]
+                if prefix not in prefix_ids:
+                    prefix_ids[prefix] = len(prefix_ids)
+                bits = 1 << prefix_ids[prefix]
+        node.add_feature('multi_descendants', bits)
+    return prefix_ids
+
+
+def match_score(set1, set2):
+    """
+    Match score between prefix sets.
+
+    Only the intersection is built; union size is |A| + |B| - |A and B|.
+    Two empty sets score 0.
+    :param set1:
+    :param set2:
+    :return:
+    """
+    common = len(set1 & set2)
+    union = len(set1) + len(set2) - common
+    return common/union if union else 0.0
+
+
+def _popcount(bits):
+    """
+    Number of set bits in a non-negative int
+    :param bits:
+    :return:
+    """
+    return bin(bits).count('1')
+
+
+# int.bit_count (Python 3.10+) counts bits without building a string
+popcount = getattr(int, 'bit_count', _popcount)
+
+
+def bits_score(bits1, bits2):
+    """
+    Match score between prefix bitmasks.
+
+    Same as match_score, but for the bitmasks from annotate_tree: bit counts
+    of ints instead of building and intersecting two sets.
+    :param bits1:
+    :param bits2:
+    :return:
+    """
+    return score_all(bits1, (bits2,))[0]
+
+
+def _scores(mask, count, masks, counts, indices):
+    """
+    Match scores of one prefix bitmask against masks[j] for j in indices.
+
+    count is popcount(mask), and counts are popcounts of masks, so that they
+    are computed once by the caller. |A or B| = |A| + |B| - |A and B|, so only
+    the AND is counted per pair. Two empty masks score 0.
+    :param mask:
+    :param count:
+    :param masks:
+    :param counts:
+    :param indices:
+    :return:
+    """
+    scores = []
+    for j in indices:
+        common = popcount(mask & masks[j])
+        union = count + counts[j] - common
+        scores.append(common/union if union else 0.0)
+    return scores
+
+
+def score_matrix(masks, threshold=0):
+    """
+    Square matrix of match scores between all pairs of prefix bitmasks.
+
+    The score is symmetric, so only the upper triangle is computed and
+    mirrored. Score cannot exceed the ratio of smaller set size to larger set
+    size, so pairs for which this ratio is below threshold are not scored and
+    left at 0. Returns a list of lists.
+    :param masks:
+    :param threshold:
+    :return:
+    """
+    size = len(masks)
+    counts = [popcount(x) for x in masks]
+    matrix = [[0.0] * size for _ in range(size)]
+    # With masks sorted by size, the partners that can pass the threshold form
+    # a contiguous window, so the rest of the pairs are never even looked at
+    order = sorted(range(size), key=counts.__getitem__)
+    sorted_counts = [counts[x] for x in order]
+    end = 0
+    for position, i in enumerate(order):
+        mask = masks[i]
+        count = counts[i]
+        line = matrix[i]
+        # Window end only moves forward as count grows. The best possible
+        # score is count/other_count, computed with the same division as the
+        # score itself, so pairs exactly at the threshold are kept
+        while end < size and (not sorted_counts[end] or
+                              count/sorted_counts[end] >= threshold):
+            end += 1
+        window = order[position:end]
+        for j, score in zip(window,
+                            _scores(mask, count, masks, counts, window)):
+            line[j] = matrix[j][i] = score
+    return matrix
 
 
-def add_multi_annotation(node, multies):
+def score_all(mask, masks):
     """
-    Add a list of multiples descending from this node to node annotation
+    Match scores of one prefix bitmask against a list of bitmasks.
 
-    Assumes leaf-first traversal. If called for a node before any of its
-    descendants, this function will break.
+    Same as [bits_score(mask, x) for x in masks], but the size of mask is only
+    counted once. To pick the best candidates, use best_matches.
+    :param mask:
+    :param masks:
+    :return:
     """
-    if node.is_leaf():
-        # For a leaf, add either name or nothing
-        node.add_feature('multi_descendants', [])
-        if node.name in multies:
-            node.multi_descendants.append('_'.join(node.name.split('_')[:-1]))
-    else:
-        node.add_feature('multi_descendants', [])
-        for child in node.children:
-            node.multi_descendants += child.multi_descendants
+    counts = [popcount(x) for x in masks]
+    return _scores(mask, popcount(mask), masks, counts, range(len(masks)))
 
 
-def match_score(vector1, vector2):
+def best_matches(mask, masks):
     """
-    Match score between prefix lists.
-    :param vector1:
-    :param vector2:
+    Get indices of all prefix bitmasks that have the best score against mask.
+
+    Same as maxindices(score_all(mask, masks)), except that an empty list of
+    masks has no matches instead of raising.
+    :param mask:
+    :param masks:
     :return:
     """
-    s1 = set(vector1)
-    s2 = set(vector2)
-    return len(s1.intersection(s2))/len(s1.union(s2))
+    scores = score_all(mask, masks)
+    return maxindices(scores) if scores else []
 
 
 def maxindices(l):
@@ -93,14 +302,10 @@ def hmmer_name_mapping(names, rsga_style=False):
             r[name] = name.split(' [subseq')[0]
         # processing two different variants of the subseq marker (at least in
         # RsgA it was filtered at some point to remove square brackets)
-    used_queries = set()
-    if rsga_style:
-        first_pos_re = re.compile('(\d+)-\d+')
-    else:
-        first_pos_re = re.compile('/(\d+)-\d+ ')
+    first_pos_re = _RSGA_POS_RE if rsga_style else _HMMER_POS_RE
+    # Group names by query first, so that each sequence is looked at once
+    by_query = defaultdict(list)
     for name in r:
-        # Renumber subdomains so that they use their position
-        # in a given protein instead of coordinates
         if r[name][-2] == '_':
             # If the name has already been postfixed, it cannot be processed
             # by the code below
@@ -109,41 +314,218 @@ def hmmer_name_mapping(names, rsga_style=False):
             query = re.split(first_pos_re, r[name])[0]
         else:
             query = r[name].split('/')[0]
-        if query in used_queries:
-            continue
-        used_queries.add(query)
-        matches = {x: r[x] for x in r if query in x}
-        if len(matches) > 1:
+        by_query[query].append(name)
+    for query, query_names in by_query.items():
+        # Renumber subdomains so that they use their position
+        # in a given protein instead of coordinates
+        if len(query_names) > 1:
             # Add correct number
             positions = {}
-            for x in matches:
+            for x in query_names:
                 re_match = first_pos_re.search(x)
-                first_pos = re_match.groups(1)
-                positions[x] = int(first_pos[0])
-            first_pos = list(positions.values())
-            first_pos.sort()
-            for name in matches:
-                r[name] = query + '_' + str(first_pos.index(positions[name]) + 1)
+                positions[x] = int(re_match.group(1))
+            first_pos = sorted(positions.values())
+            for x in query_names:
+                r[x] = query + '_' + str(first_pos.index(positions[x]) + 1)
         else:
             # Don't add postfixes and discard coordinates
             # if it is the only domain in a sequence
-            r[name] = query + '_1'
+            r[query_names[0]] = query + '_1'
     return r
 
 
-def are_ancestors(node1, node2):
+def is_ancestor(node1, node2, tin, tout):
     """
-    Take two ete3 tree nodes.
+    Return True if node1 is the ancestor of node2 (but not node2 itself)
+
+    tin and tout are DFS entry and exit times, as produced by dfs_intervals
+    :param node1:
+    :param node2:
+    :param tin:
+    :param tout:
+    :return:
+    """
+    return tin[node1] < tin[node2] and tout[node2] < tout[node1]
+
+
+def are_ancestors(node1, node2, tin, tout):
+    """
+    Take two ete3 tree nodes and their tree's DFS intervals.
 
     Return True if either is the ancestor of another
     :param node1:
     :param node2:
+    :param tin:
+    :param tout:
+    :return:
+    """
+    return is_ancestor(node1, node2, tin, tout) or \
+        is_ancestor(node2, node1, tin, tout)
+
+
+def dfs_intervals(tree):
+    """
+    Get DFS entry and exit times for all nodes of the tree.
+
+    Node A is an ancestor of node B (or B itself) if and only if
+    tin[A] <= tin[B] and tout[B] <= tout[A], so ancestry checks become two
+    integer comparisons instead of walks along parent links.
+    Returns two dicts {node: time} and a list of all nodes in postorder (same
+    as ete3's postorder traversal, but without its generator overhead)
+    :param tree:
+    :return:
+    """
+    tin = {}
+    tout = {}
+    postorder = []
+    clock = 0
+    # Iterative, so that deep (eg caterpillar) trees don't hit recursion limit
+    stack = [(tree, False)]
+    while stack:
+        node, visited = stack.pop()
+        if visited:
+            tout[node] = clock
+            postorder.append(node)
+        else:
+            tin[node] = clock
+            stack.append((node, True))
+            stack.extend((child, False) for child in reversed(node.children))
+        clock += 1
+    return tin, tout, postorder
+
+
+def reciprocal_matches(match_matrix, tin, tout, threshold):
+    """
+    Find pairs of unrelated nodes that pass the score threshold.
+
+    Takes a symmetric match matrix (list of lists, see score_matrix) and DFS
+    entry and exit times of matrix nodes (lists in the same order, see
+    dfs_intervals).
+    Returns a list of index pairs (i, j) with i < j.
+    :param match_matrix:
+    :param tin:
+    :param tout:
+    :param threshold:
+    :return:
+    """
+    matches = []
+    for index, line in enumerate(match_matrix):
+        tin_index = tin[index]
+        tout_index = tout[index]
+        for element in range(index+1, len(line)):
+            if line[element] < threshold:
+                # Match quality cutoff. Can be tweaked to choose between larger
+                # looser groups (at lower values) and exact matches (at 1.0)
+                # The score is symmetric, so a reverse check is not needed
+                continue
+            # Skip the pair if either node is the ancestor of another
+            if tin_index <= tin[element] <= tout_index or \
+                    tin[element] <= tin_index <= tout[element]:
+                continue
+            matches.append((index, element))
+    return matches
+
+
+def remove_nested_matches(matches, tin, tout):
+    """
+    Preserve only the most ancient possible matches, discarding newer ones.
+
+    Match (A, B) is removed if there is a match (C, D) such that C is the
+    ancestor of A and D is the ancestor of B, or a match (A, C) such that C is
+    the ancestor of B.
+    Takes a list of index pairs (see reciprocal_matches) and DFS entry and exit
+    times for the indexed nodes, returns the filtered list.
+    :param matches:
+    :param tin:
+    :param tout:
     :return:
     """
-    for ancestor in node1.iter_ancestors():
-        if ancestor == node2:
-            return True
-    for ancestor in node2.iter_ancestors():
-        if ancestor == node1:
-            return True
-    return False
\ No newline at end of file
+    # Look the intervals up once per match rather than once per comparison
+    spans = [(a, b, tin[a], tout[a], tin[b], tout[b]) for a, b in matches]
+    clean_matches = []
+    for index, (a, b, a_in, a_out, b_in, b_out) in enumerate(spans):
+        found = False
+        for other_index, (c, d, c_in, c_out, d_in, d_out) in enumerate(spans):
+            if index == other_index:
+                continue
+            # C is the ancestor of A and D is the ancestor of B, or vice versa
+            if c_in < a_in and a_out < c_out and d_in < b_in and b_out < d_out or \
+                    d_in < a_in and a_out < d_out and c_in < b_in and b_out < c_out:
+                found = True
+                break
+            if (a == c or a == d) and (c_in < b_in and b_out < c_out or
+                                       d_in < b_in and b_out < d_out):
+                found = True
+                break
+            if (b == c or b == d) and (c_in < a_in and a_out < c_out or
+                                       d_in < a_in and a_out < d_out):
+                found = True
+                break
+        if not found:
+            clean_matches.append((a, b))
+    return clean_matches
+
+
+class DisjointSet:
+    """
+    Union-find structure over arbitrary hashable objects (ete3 nodes in
+    practice).
+
+    Uses union by rank and path compression, so both `find` and `union` run
+    in nearly constant amortized time.
+    """
+    def __init__(self):
+        self.parent = {}
+        self.rank = {}
+
+    def add(self, x):
+        """
+        Make a singleton set for x, unless x is already known
+        :param x:
+        :return:
+        """
+        if x not in self.parent:
+            self.parent[x] = x
+            self.rank[x] = 0
+
+    def find(self, x):
+        """
+        Return the representative of the set containing x
+        :param x:
+        :return:
+        """
+        root = x
+        while self.parent[root] is not root:
+            root = self.parent[root]
+        # Path compression: point everything on the way directly at the root
+        while self.parent[x] is not root:
+            self.parent[x], x = root, self.parent[x]
+        return root
+
+    def union(self, x, y):
+        """
+        Merge sets containing x and y
+        :param x:
+        :param y:
+        :return:
+        """
+        x_root = self.find(x)
+        y_root = self.find(y)
+        if x_root is y_root:
+            return
+        # Link the shorter tree under the taller one
+        if self.rank[x_root] < self.rank[y_root]:
+            x_root, y_root = y_root, x_root
+        self.parent[y_root] = x_root
+        if self.rank[x_root] == self.rank[y_root]:
+            self.rank[x_root] += 1
+
+    def groups(self):
+        """
+        Return all sets as a list of python sets
+        :return:
+        """
+        r = {}
+        for x in self.parent:
+            r.setdefault(self.find(x), set()).add(x)
+        return list(r.values())
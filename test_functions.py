@@ -1,8 +1,28 @@
 """
 Tests for various routines
 """
-from processing import sub_replacement, change_support_format, trim_name
+from processing import sub_replacement, change_support_format, \
+    change_support_format_many, change_support_format_stream, trim_name, \
+    DisjointSet, match_score, bits_score, score_matrix, reciprocal_matches, \
+    is_ancestor, are_ancestors, remove_nested_matches, hmmer_name_mapping, \
+    maxindices, best_matches, score_all, popcount, _popcount, dfs_intervals, \
+    annotate_tree
 import re
+import pytest
+from array import array
+from ete3 import Tree
+
+
+class StubNode:
+    """
+    Minimal stand-in for an ete3 node: name, children and add_feature
+    """
+    def __init__(self, name, children=()):
+        self.name = name
+        self.children = list(children)
+
+    def add_feature(self, name, value):
+        setattr(self, name, value)
 
 
 def test_node_processing():
@@ -20,6 +40,41 @@ def test_support_reformating():
     assert change_support_format(escaped_tree) == '((\'A\':1, \'B\':0.7)65:0.8, \'C\')'
     decimal_tree = '((A:1, B:0.7):0.8[0.7331], C)'
     assert change_support_format(decimal_tree) == '((A:1, B:0.7)0.7331:0.8, C)'
+    exponent_tree = '((A:1, B:0.7):2.5e-05[1E+02], C)'
+    assert change_support_format(exponent_tree) == '((A:1, B:0.7)1E+02:2.5e-05, C)'
+    assert change_support_format_many([simple_tree, decimal_tree]) == \
+        ['((A:1, B:0.7)65:0.8, C)', '((A:1, B:0.7)0.7331:0.8, C)']
+
+
+def test_support_reformating_stream(tmp_path):
+    in_path = tmp_path / 'in.nwk'
+    out_path = tmp_path / 'out.nwk'
+    in_path.write_text('((A:1, B:0.7):0.8[65], C);\n((A:1, B:0.7):0.8[0.7331], C);\n')
+    change_support_format_stream(str(in_path), str(out_path))
+    assert out_path.read_text() == \
+        '((A:1, B:0.7)65:0.8, C);\n((A:1, B:0.7)0.7331:0.8, C);\n'
+    # In place conversion doesn't truncate the input before reading it
+    change_support_format_stream(str(in_path), str(in_path))
+    assert in_path.read_text() == out_path.read_text()
+    # Empty input gives empty output
+    in_path.write_text('')
+    change_support_format_stream(str(in_path), str(out_path))
+    assert out_path.read_text() == ''
+    # A file named like the old fixed temp file is left alone
+    (tmp_path / 'out.nwk.tmp').write_text('keep')
+    in_path.write_text('((A:1, B:0.7):0.8[65], C);\n')
+    change_support_format_stream(in_path, out_path)
+    assert out_path.read_text() == '((A:1, B:0.7)65:0.8, C);\n'
+    # Output gets the usual permissions, not the private ones of mkstemp
+    assert out_path.stat().st_mode == in_path.stat().st_mode
+    assert (tmp_path / 'out.nwk.tmp').read_text() == 'keep'
+    assert sorted(x.name for x in tmp_path.iterdir()) == \
+        ['in.nwk', 'out.nwk', 'out.nwk.tmp']
+    # A failed conversion leaves no temporary files behind
+    with pytest.raises(FileNotFoundError):
+        change_support_format_stream(tmp_path / 'missing.nwk', out_path)
+    assert sorted(x.name for x in tmp_path.iterdir()) == \
+        ['in.nwk', 'out.nwk', 'out.nwk.tmp']
 
 
 def test_name_trimming():
@@ -29,3 +84,162 @@ def test_name_trimming():
     # Clean sequences are unaffected
     clean_name = 'Skeletonema_costatum,_Strain_1716|CAMPEP_0113383910_2'
     assert trim_name(clean_name) == clean_name
+    # Every position is removed, not just the first one
+    double_name = 'CAMPEP_0199315576_(5-177)_(180-350)_1'
+    assert trim_name(double_name) == 'CAMPEP_0199315576_1'
+
+
+def test_disjoint_set():
+    ds = DisjointSet()
+    for x in 'ABCDE':
+        ds.add(x)
+    # Transitively overlapping pairs end up in a single group
+    ds.union('A', 'B')
+    ds.union('C', 'D')
+    ds.union('B', 'C')
+    assert ds.find('A') is ds.find('D')
+    assert ds.find('E') is not ds.find('A')
+    assert sorted(sorted(x) for x in ds.groups()) == [['A', 'B', 'C', 'D'], ['E']]
+
+
+def test_popcount():
+    # The bin() fallback is only used before Python 3.10, so check it directly
+    for x in (0, 1, 0b1011, (1 << 100) - 1):
+        assert _popcount(x) == popcount(x) == bin(x).count('1')
+    assert _popcount((1 << 100) - 1) == 100
+
+
+def test_bits_score():
+    ids = {'A': 0, 'B': 1, 'C': 2, 'D': 3}
+    v1 = frozenset(('A', 'B', 'C'))
+    v2 = frozenset(('B', 'C', 'D'))
+    b1 = sum(1 << ids[x] for x in v1)
+    b2 = sum(1 << ids[x] for x in v2)
+    assert bits_score(b1, b2) == match_score(v1, v2) == 0.5
+    assert bits_score(b1, b1) == 1.0
+    # Empty prefix sets score 0 instead of dividing by zero
+    assert bits_score(0, 0) == match_score(frozenset(), frozenset()) == 0.0
+
+
+def test_score_matrix():
+    b1 = 0b0111
+    b2 = 0b1110
+    assert score_matrix([b1, b2]) == [[1.0, 0.5], [0.5, 1.0]]
+    # A single prefix against three cannot score above 1/3
+    assert score_matrix([b1, 0b1000], 0.5) == [[1.0, 0], [0, 1.0]]
+    # Size ratio 1/4 between the first and the last mask rules that pair out
+    assert score_matrix([0b1111, 0b1, 0b11], 0.5) == \
+        [[1.0, 0, 0.5], [0, 1.0, 0.5], [0.5, 0.5, 1.0]]
+    # A subset pair scoring exactly the threshold is not lost to the size bound
+    for threshold in (0.14, 0.28, 0.55, 0.56, 0.68):
+        small = (1 << round(threshold * 50)) - 1
+        matrix = score_matrix([small, (1 << 50) - 1], threshold)
+        assert matrix[0][1] == popcount(small) / 50 >= threshold
+        assert reciprocal_matches(matrix, [0, 2], [1, 3], threshold) == [(0, 1)]
+    # Empty masks score 0 instead of dividing by zero
+    assert score_matrix([0, 0b1]) == [[0.0, 0.0], [0.0, 1.0]]
+
+
+def test_score_all():
+    b1 = 0b0111
+    candidates = [0b1110, 0b1000, 0b1110, 0b1111]
+    assert score_all(b1, candidates) == [bits_score(b1, x) for x in candidates]
+    assert score_all(0, [0, 0b1]) == [0.0, 0.0]
+
+
+def test_best_matches():
+    b1 = 0b0111
+    candidates = [0b1110, 0b1000, 0b1110, 0b1111]
+    assert best_matches(b1, candidates) == \
+        maxindices([bits_score(b1, x) for x in candidates]) == [3]
+    assert best_matches(b1, candidates[:3]) == [0, 2]
+    assert best_matches(0, [0, 0b1]) == [0, 1]
+    assert best_matches(b1, []) == []
+
+
+def test_reciprocal_matches():
+    matrix = [[1.0, 0.6, 0.9, 0.2],
+              [0.6, 1.0, 0.4, 0.7],
+              [0.9, 0.4, 1.0, 0.1],
+              [0.2, 0.7, 0.1, 1.0]]
+    # Node 2 is a descendant of node 0, others are unrelated
+    tin = [0, 5, 1, 7]
+    tout = [4, 6, 2, 8]
+    assert reciprocal_matches(matrix, tin, tout, 0.5) == [(0, 1), (1, 3)]
+    assert reciprocal_matches(matrix, tin, tout, 0.65) == [(1, 3)]
+
+
+def test_interval_ancestry():
+    # Intervals for ((A, B)AB, C)root
+    tin = {'root': 0, 'AB': 1, 'A': 2, 'B': 4, 'C': 7}
+    tout = {'root': 9, 'AB': 6, 'A': 3, 'B': 5, 'C': 8}
+    assert is_ancestor('root', 'A', tin, tout)
+    assert is_ancestor('AB', 'B', tin, tout)
+    assert not is_ancestor('A', 'AB', tin, tout)
+    assert not is_ancestor('AB', 'AB', tin, tout)
+    assert are_ancestors('B', 'AB', tin, tout)
+    assert not are_ancestors('AB', 'C', tin, tout)
+
+
+def test_dfs_intervals():
+    # ((A, B)AB, C)root, same intervals as in test_interval_ancestry
+    a, b, c = StubNode('A'), StubNode('B'), StubNode('C')
+    ab = StubNode('AB', (a, b))
+    root = StubNode('root', (ab, c))
+    tin, tout, postorder = dfs_intervals(root)
+    assert [x.name for x in postorder] == ['A', 'B', 'AB', 'C', 'root']
+    assert {x.name: tin[x] for x in postorder} == \
+        {'root': 0, 'AB': 1, 'A': 2, 'B': 4, 'C': 7}
+    assert {x.name: tout[x] for x in postorder} == \
+        {'root': 9, 'AB': 6, 'A': 3, 'B': 5, 'C': 8}
+    assert is_ancestor(root, a, tin, tout)
+    assert not are_ancestors(ab, c, tin, tout)
+
+
+def test_annotate_tree():
+    # ((A_1, B_1)AB, (A_2, C)AC)root with A_1, B_1 and A_2 being multiples
+    multies = ['A_1', 'B_1', 'A_2']
+    masks = {'A_1': 0b01, 'B_1': 0b10, 'AB': 0b11, 'A_2': 0b01, 'C': 0,
+             'AC': 0b01, 'root': 0b11}
+    leaves = [StubNode(x) for x in ('A_1', 'B_1', 'A_2', 'C')]
+    ab = StubNode('AB', leaves[:2])
+    ac = StubNode('AC', leaves[2:])
+    root = StubNode('root', (ab, ac))
+    _, _, postorder = dfs_intervals(root)
+    assert annotate_tree(root, multies, postorder) == {'A': 0, 'B': 1}
+    assert {x.name: x.multi_descendants for x in postorder} == masks
+    # Real tree, with postorder computed inside
+    tree = Tree('((A_1, B_1)AB, (A_2, C)AC)root;', format=1)
+    assert annotate_tree(tree, multies) == {'A': 0, 'B': 1}
+    assert {x.name: x.multi_descendants for x in tree.traverse()} == masks
+
+def test_nested_match_removal():
+    # Indices for ((0, (1, 2)), (3, (4, 5))) with internal nodes 6 to 9:
+    # 6 = (1, 2), 7 = (0, 6), 8 = (4, 5), 9 = (3, 8)
+    tin = [2, 5, 7, 12, 15, 17, 4, 1, 14, 11]
+    tout = [3, 6, 8, 13, 16, 18, 9, 10, 19, 20]
+    # (6, 8) and (0, 3) are nested in (7, 9); (7, 8) is removed because 9
+    # includes 8
+    matches = [(6, 8), (7, 9), (7, 8), (0, 3)]
+    assert remove_nested_matches(matches, tin, tout) == [(7, 9)]
+    assert remove_nested_matches([(6, 8), (0, 3)], tin, tout) == [(6, 8), (0, 3)]
+
+
+def test_hmmer_name_mapping():
+    names = ['seqA/150-250 [subseq from] x', 'seqA/5-100 [subseq from] x',
+             'seqB/1-90 [subseq from] x', 'seqA1/20-90 [subseq from] x']
+    assert hmmer_name_mapping(names) == {
+        'seqA/150-250 [subseq from] x': 'seqA_2',
+        'seqA/5-100 [subseq from] x': 'seqA_1',
+        'seqB/1-90 [subseq from] x': 'seqB_1',
+        'seqA1/20-90 [subseq from] x': 'seqA1_1'}
+
+
+def test_maxindices():
+    assert maxindices([0.1, 0.7, 0.3, 0.7]) == [1, 3]
+    assert maxindices([5]) == [0]
+    assert maxindices((2, 1, 0)) == [0]
+    # Any indexable sequence works, not only lists
+    assert maxindices(range(3)) == [2]
+    assert maxindices(array('d', [0.5, 0.2, 0.5])) == [0, 2]
+    assert maxindices([float('nan'), 1.0]) == []